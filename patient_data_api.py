@@ -1,121 +1,206 @@
-from fastapi import FastAPI, Path, Query, HTTPException
-from fastapi.responses import JSONResponse
-
-from utils import load_patient_data, save_patient_data
-from utils import Patient, UpdatePatient
-
-
-app = FastAPI()
+import asyncio
+import logging
+import sqlite3
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Path, Query, Body, HTTPException, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response
+from typing import List
+import msgspec
+
+from utils import load_patient_data_async, save_changes_async, get_patient_bytes, get_view_bytes, open_database, sync_shared_snapshot
+from utils import Patient, UpdatePatient, SORTABLE_FIELDS, get_sorted_patients_bytes, calculate_bmi, bmi_verdict
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the database, refresh a leftover shared snapshot and warm the in-memory cache
+    await asyncio.to_thread(open_database)
+    await asyncio.to_thread(sync_shared_snapshot)
+    await load_patient_data_async()
+    yield
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+app.add_middleware(GZipMiddleware, minimum_size=512)
+
+logger = logging.getLogger(__name__)
+
+
+@app.exception_handler(sqlite3.OperationalError)
+async def database_error(request: Request, exc: sqlite3.OperationalError):
+    # Only lock contention (after the busy timeout) is worth retrying, the extended codes share the low byte
+    if exc.sqlite_errorcode is not None and exc.sqlite_errorcode & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED):
+        return ORJSONResponse(status_code=503, content={"detail": "Database is busy, please try again."})
+    # Anything else (missing table, I/O error, read-only file...) is a real fault
+    logger.error("Database error on %s %s", request.method, request.url.path, exc_info=exc)
+    return ORJSONResponse(status_code=500, content={"detail": "Internal Server Error"})
+
+
+def decode_body(body: bytes, model):
+    """Validate a raw JSON request body straight into a msgspec Struct"""
+    try:
+        return msgspec.json.decode(body, type=model)
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+def json_body(model, many=False):
+    """OpenAPI request body for endpoints that decode the raw body themselves"""
+    _, components = msgspec.json.schema_components([model])
+    schema = components[model.__name__]
+    if many:
+        schema = {"type": "array", "items": schema}
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": schema}},
+        }
+    }
 
 @app.get("/API INFO")
-def info():
+async def info():
     return {
         "name": "Patient Data API",
         "version": "1.0.0",
         "description": "API to handle patient data."
     }
 
-@app.get("/view_patients_data")
-def view():
-    data = load_patient_data()
-    return {
-        "status": "success",
-        "data": data
-    }
+@app.get("/view_patients_data", response_model=None)
+async def view():
+    data = await load_patient_data_async()
+    return Response(content=get_view_bytes(data), media_type="application/json")
 
-@app.get("/patients/{patient_id}")
-def get_patient(
+@app.get("/patients/{patient_id}", response_model=None)
+async def get_patient(
     patient_id: str = Path(..., description="The ID of the patient in the database", example="P001")
     ):
     # Load patient data
-    data = load_patient_data()
+    data = await load_patient_data_async()
     if patient_id in data:
-        return {
-            "status": "success",
-            "data": data[patient_id]
-        }
+        return Response(content=get_patient_bytes(data, patient_id), media_type="application/json")
     raise HTTPException(status_code=404, detail="Patient not found")
 
-@app.get("/sort_patients")
-def sort_patients(
+@app.get("/sort_patients", response_model=None)
+async def sort_patients(
     sort_by: str = Query(..., description="Sort patient data based on height, weight, or bmi", example="height"),
     order: str = Query(..., description="Order of sorting: asc or desc", example="asc")
     ):
-    valid_fields = ["height", "weight", "bmi"]
+    valid_fields = SORTABLE_FIELDS
     if sort_by not in valid_fields:
         raise HTTPException(status_code=400, detail=f"Invalid sort field. Select from {valid_fields}.")
 
     if order not in ["asc", "desc"]:
         raise HTTPException(status_code=400, detail="Invalid order. Use 'asc' or 'desc'.")
     
-    # Load patient data
-    data = load_patient_data()
+    # Sort data in the database
+    sorted_data = await asyncio.to_thread(get_sorted_patients_bytes, sort_by, order == "desc")
+    return Response(content=sorted_data, media_type="application/json")
 
-    # Sort data
-    sort_order = True if order == "desc" else False
-    sorted_data = sorted(data.values(), key=lambda x: x.get(sort_by, 0), reverse=sort_order)
-    return {
-        "status": "success",
-        "data": sorted_data
-    }
+@app.post("/add_patient", openapi_extra=json_body(Patient))
+async def add_patient(request: Request):
+    patient = decode_body(await request.body(), Patient)
 
-@app.post("/add_patient")
-def add_patient(patient: Patient):
     # Load existing patient data
-    data = load_patient_data()
+    data = await load_patient_data_async()
 
     # Check if patient already exists
     if patient.id in data:
         raise HTTPException(status_code=400, detail="Patient with this ID already exists.")
 
-    # Add new patient data
-    data[patient.id] = patient.model_dump(exclude={'id'})
-    
-    # Save updated data
-    save_patient_data(data)
+    # Add new patient data, the primary key catches ids added since our cache was loaded
+    try:
+        await save_changes_async([("add", patient.id, patient.to_record())])
+    except sqlite3.IntegrityError:
+        raise HTTPException(status_code=400, detail="Patient with this ID already exists.")
+
+    return ORJSONResponse(status_code=201, content={"status": "success", "message": "Patient added successfully."})
+
+@app.post("/patients:batch", openapi_extra=json_body(Patient, many=True))
+async def add_patients_batch(request: Request):
+    # Split the array without parsing the items, each one is validated straight from its bytes below
+    patients = decode_body(await request.body(), List[msgspec.Raw])
+
+    # Load existing patient data once for the whole batch
+    data = await load_patient_data_async()
+
+    results = []
+    changes = []
+    added = set()
+    for item in patients:
+        try:
+            patient = msgspec.json.decode(item, type=Patient)
+        except msgspec.ValidationError as e:
+            item = msgspec.json.decode(item)
+            patient_id = item.get("id") if isinstance(item, dict) else None
+            results.append({"id": patient_id, "status": "error", "detail": str(e)})
+            continue
+
+        # `data` is the shared cache, so track this batch's ids separately instead of adding them to it
+        if patient.id in data or patient.id in added:
+            results.append({"id": patient.id, "status": "error", "detail": "Patient with this ID already exists."})
+            continue
+
+        added.add(patient.id)
+        changes.append(("add", patient.id, patient.to_record()))
+        results.append({"id": patient.id, "status": "ok", "detail": None})
+
+    # Save all additions in a single transaction
+    if changes:
+        duplicates = set(await save_changes_async(changes, skip_duplicates=True))
+        for result in results:
+            if result["status"] == "ok" and result["id"] in duplicates:
+                result.update(status="error", detail="Patient with this ID already exists.")
+
+    return {"status": "success", "results": results}
+
+@app.post("/patients:mget")
+async def get_patients_batch(ids: List[str] = Body(..., description="IDs of the patients to fetch", examples=[["P001", "P002"]])):
+    # Load patient data
+    data = await load_patient_data_async()
 
-    return JSONResponse(status_code=201, content={"status": "success", "message": "Patient added successfully."})
+    found = {patient_id: data[patient_id] for patient_id in ids if patient_id in data}
+    missing = [patient_id for patient_id in ids if patient_id not in data]
+    return {"status": "success", "data": found, "missing": missing}
+
+@app.put("/update_patient/{patient_id}", openapi_extra=json_body(UpdatePatient))
+async def update_patient(patient_id: str, request: Request):
+    update_data = decode_body(await request.body(), UpdatePatient)
 
-@app.put("/update_patient/{patient_id}")
-def update_patient(patient_id: str, update_data: UpdatePatient):
     # Load existing patient data
-    data = load_patient_data()
+    data = await load_patient_data_async()
 
     # Check if patient exists
     if patient_id not in data:
         raise HTTPException(status_code=404, detail="Patient not found.")
     
-    existing_patient_info = data[patient_id]
-    updated_patient_info = update_data.model_dump(exclude_unset=True)
+    existing_patient_info = dict(data[patient_id])
+    updated_patient_info = msgspec.structs.asdict(update_data)
 
     # Update patient data
     for key, value in updated_patient_info.items():
         if value is not None:
             existing_patient_info[key] = value
-    
-    existing_patient_info['id'] = patient_id
-    pydantic_patient = Patient(**existing_patient_info)
-    existing_patient_info = pydantic_patient.model_dump(exclude={'id'})
-    data[patient_id] = existing_patient_info
+
+    # Both the stored record and the update are already validated, so only recompute the derived fields
+    existing_patient_info['bmi'] = calculate_bmi(existing_patient_info['weight'], existing_patient_info['height'])
+    existing_patient_info['verdict'] = bmi_verdict(existing_patient_info['bmi'])
 
     # Save updated data
-    save_patient_data(data)
+    await save_changes_async([("put", patient_id, existing_patient_info)])
 
-    return JSONResponse(status_code=200, content={"status": "success", "message": "Patient updated successfully."})
+    return ORJSONResponse(status_code=200, content={"status": "success", "message": "Patient updated successfully."})
 
 @app.delete("/delete_patient/{patient_id}")
-def delete_patient(patient_id: str):
+async def delete_patient(patient_id: str):
     # Load existing patient data
-    data = load_patient_data()
+    data = await load_patient_data_async()
 
     # Check if patient exists
     if patient_id not in data:
         raise HTTPException(status_code=404, detail="Patient not found.")
     
     # Delete patient data
-    del data[patient_id]
-
-    # Save updated data
-    save_patient_data(data)
+    await save_changes_async([("delete", patient_id, None)])
 
-    return JSONResponse(status_code=200, content={"status": "success", "message": "Patient deleted successfully."})
\ No newline at end of file
+    return ORJSONResponse(status_code=200, content={"status": "success", "message": "Patient deleted successfully."})
\ No newline at end of file
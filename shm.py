@@ -0,0 +1,62 @@
+import fcntl
+import mmap
+import os
+from multiprocessing import resource_tracker, shared_memory
+
+import orjson
+
+
+# Shared snapshot for multi-worker deployments: set PATIENTS_SHM=1 to enable (Linux only)
+SHM_ENABLED = os.getenv("PATIENTS_SHM") == "1"
+SHM_BLOB = os.getenv("PATIENTS_SHM_BLOB", "/dev/shm/patients.bin")
+SHM_VERSION_NAME = os.getenv("PATIENTS_SHM_VERSION", "patients_version")
+
+_version = None
+
+
+def is_enabled():
+    """Check whether the shared memory snapshot is enabled"""
+    return SHM_ENABLED
+
+def _version_segment():
+    """Attach to (or create) the 8 byte segment holding the snapshot version"""
+    global _version
+    if _version is None:
+        try:
+            _version = shared_memory.SharedMemory(name=SHM_VERSION_NAME)
+        except FileNotFoundError:
+            try:
+                _version = shared_memory.SharedMemory(name=SHM_VERSION_NAME, create=True, size=8)
+            except FileExistsError:
+                _version = shared_memory.SharedMemory(name=SHM_VERSION_NAME)
+        # The segment outlives any single worker, so keep the resource tracker from unlinking it on exit
+        resource_tracker.unregister(_version._name, "shared_memory")
+    return _version
+
+def read_version():
+    """Return the generation of the published snapshot, 0 if nothing has been published yet"""
+    return int.from_bytes(_version_segment().buf[:8], "little")
+
+def load(version):
+    """Read the snapshot for `version` through a read-only mmap, or None if another one is published"""
+    if version == 0 or read_version() != version:
+        return None
+    with open(SHM_BLOB, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as blob:
+            with memoryview(blob) as view:
+                data = orjson.loads(view)
+    # A publish in the meantime resets the version first, so an unchanged version means an untouched blob
+    if read_version() != version:
+        return None
+    return data
+
+def publish(data, version):
+    """Atomically replace the snapshot and label it with `version`, the database generation it was read at"""
+    with open(f"{SHM_BLOB}.lock", "wb") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        _version_segment().buf[:8] = (0).to_bytes(8, "little")
+        tmp_path = f"{SHM_BLOB}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(orjson.dumps(data))
+        os.replace(tmp_path, SHM_BLOB)
+        _version_segment().buf[:8] = version.to_bytes(8, "little")
@@ -1,5 +1,6 @@
 import streamlit as st
-import requests
+import asyncio
+import httpx
 import json
 import pandas as pd
 from typing import Optional
@@ -15,31 +16,68 @@ st.set_page_config(
 API_BASE_URL = "http://127.0.0.1:8000"  # Change this to your FastAPI server URL
 
 # Helper functions
+@st.cache_resource
+def get_session():
+    """Shared HTTP client so connections to the API are kept alive across reruns"""
+    return httpx.Client(
+        http2=True,
+        headers={"Accept-Encoding": "gzip"},
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+    )
+
 def make_api_request(method, endpoint, data=None, params=None):
     """Make API request and handle errors"""
     try:
         url = f"{API_BASE_URL}{endpoint}"
         
-        if method == "GET":
-            response = requests.get(url, params=params)
-        elif method == "POST":
-            response = requests.post(url, json=data)
-        elif method == "PUT":
-            response = requests.put(url, json=data)
-        elif method == "DELETE":
-            response = requests.delete(url)
-        else:
-            # return None  # Invalid method
+        if method not in ("GET", "POST", "PUT", "DELETE"):
             raise ValueError("Invalid HTTP method specified.")
-        
-        return response
-    except requests.exceptions.ConnectionError:
+
+        return get_session().request(method, url, json=data, params=params)
+    except httpx.ConnectError:
         st.error("❌ Cannot connect to the API server. Make sure your FastAPI server is running.")
         return None
     except Exception as e:
         st.error(f"❌ Error: {str(e)}")
         return None
 
+@st.cache_data
+def to_csv_bytes(records_json: str) -> bytes:
+    """Encode patient records as CSV, cached on their JSON so reruns skip the work"""
+    records = json.loads(records_json)
+    df = pd.DataFrame.from_dict(records, orient="index").rename_axis("ID").reset_index()
+    return df.to_csv(index=False).encode()
+
+async def fetch_patients(patient_ids):
+    """Fetch several patients concurrently instead of one request after another"""
+    async with httpx.AsyncClient(base_url=API_BASE_URL, http2=True) as client:
+        return await asyncio.gather(*(client.get(f"/patients/{patient_id}") for patient_id in patient_ids))
+
+def get_patients(patient_ids):
+    """Fetch several patients in parallel, returning the found records and the missing IDs"""
+    try:
+        responses = asyncio.run(fetch_patients(patient_ids))
+    except httpx.ConnectError:
+        st.error("❌ Cannot connect to the API server. Make sure your FastAPI server is running.")
+        return None, None
+    except Exception as e:
+        st.error(f"❌ Error: {str(e)}")
+        return None, None
+
+    found = {}
+    missing = []
+    for patient_id, response in zip(patient_ids, responses):
+        if response.status_code == 200:
+            try:
+                found[patient_id] = response.json()["data"]
+            except (ValueError, KeyError) as e:
+                st.error(f"❌ Error reading patient {patient_id}: {str(e)}")
+        elif response.status_code == 404:
+            missing.append(patient_id)
+        else:
+            display_api_response(response)
+    return found, missing
+
 def display_api_response(response):
     """Display API response in a formatted way"""
     if response and response.status_code == 200:
@@ -87,17 +125,11 @@ def main():
                 
                 if data["data"]:
                     # Convert to DataFrame for better display
-                    patients_list = []
-                    for patient_id, patient_info in data["data"].items():
-                        patient_row = {"ID": patient_id}
-                        patient_row.update(patient_info)
-                        patients_list.append(patient_row)
-                    
-                    df = pd.DataFrame(patients_list)
+                    df = pd.DataFrame.from_dict(data["data"], orient="index").rename_axis("ID").reset_index()
                     st.dataframe(df, use_container_width=True)
                     
                     # Download option
-                    csv = df.to_csv(index=False)
+                    csv = to_csv_bytes(json.dumps(data["data"]))
                     st.download_button(
                         label="📥 Download as CSV",
                         data=csv,
@@ -111,9 +143,23 @@ def main():
     elif page == "Get Patient by ID":
         st.header("🔍 Get Patient by ID")
         
-        patient_id = st.text_input("Enter Patient ID:", placeholder="e.g., P001")
+        patient_id = st.text_input("Enter Patient ID(s):", placeholder="e.g., P001 or P001, P002")
+        patient_ids = [pid.strip() for pid in patient_id.split(",") if pid.strip()]
         
-        if st.button("Get Patient") and patient_id:
+        clicked = st.button("Get Patient")
+
+        if clicked and len(patient_ids) > 1:
+            found, missing = get_patients(patient_ids)
+
+            if found:
+                st.success(f"✅ Found {len(found)} patient(s)!")
+                df = pd.DataFrame.from_dict(found, orient="index").rename_axis("ID").reset_index()
+                st.dataframe(df, use_container_width=True)
+            if missing:
+                st.warning(f"⚠️ Patients not found: {', '.join(missing)}")
+
+        elif clicked and patient_ids:
+            patient_id = patient_ids[0]
             response = make_api_request("GET", f"/patients/{patient_id}")
             data = display_api_response(response)
             
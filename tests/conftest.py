@@ -0,0 +1,45 @@
+import asyncio
+import os
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import shm
+import utils
+from patient_data_api import app
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """Point the storage layer at an empty data directory with the shared snapshot disabled"""
+    monkeypatch.setattr(utils, "DB_FILE", str(tmp_path / "patients.db"))
+    monkeypatch.setattr(utils, "DATA_FILE", str(tmp_path / "patient_details.json"))
+    monkeypatch.setattr(utils, "WAL_FILE", str(tmp_path / "patient_details.wal"))
+    monkeypatch.setattr(shm, "SHM_ENABLED", False)
+    utils._read_conn = utils._write_conn = utils._stamp_conn = None
+    utils.invalidate_patient_cache()
+    yield tmp_path
+    reset_connections()
+
+
+@pytest.fixture
+def client(store):
+    with TestClient(app) as client:
+        yield client
+
+
+def load_patients():
+    """Load patient data the way the endpoints do"""
+    return asyncio.run(utils.load_patient_data_async())
+
+
+def reset_connections():
+    """Close the cached connections so the next access reopens the database"""
+    for conn in (utils._read_conn, utils._write_conn, utils._stamp_conn):
+        if conn is not None:
+            conn.close()
+    utils._read_conn = utils._write_conn = utils._stamp_conn = None
+    utils.invalidate_patient_cache()
@@ -0,0 +1,125 @@
+import sqlite3
+
+import utils
+
+
+def patient(patient_id, **overrides):
+    body = {"id": patient_id, "name": "Asha", "city": "Pune", "age": 30, "gender": "female",
+            "height": 1.65, "weight": 60}
+    body.update(overrides)
+    return body
+
+
+def test_busy_database_returns_503(client):
+    assert client.post("/add_patient", json=patient("P001")).status_code == 201
+    utils._writer().execute("PRAGMA busy_timeout = 50")
+    other = sqlite3.connect(utils.DB_FILE, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        response = client.delete("/delete_patient/P001")
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+
+    assert response.status_code == 503
+    assert client.get("/patients/P001").status_code == 200
+
+
+def test_other_database_errors_return_500(client, caplog):
+    other = sqlite3.connect(utils.DB_FILE, isolation_level=None)
+    other.execute("DROP TABLE patients")
+    other.close()
+
+    response = client.get("/sort_patients", params={"sort_by": "bmi", "order": "asc"})
+
+    assert response.status_code == 500
+    assert "no such table" in caplog.text
+
+
+def external_write(sql, *params):
+    """Write from another connection, bumping the generation the way any writer does"""
+    other = sqlite3.connect(utils.DB_FILE, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    other.execute(sql, params)
+    other.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+    other.execute("COMMIT")
+    other.close()
+
+
+def test_get_patient_reflects_writes(client):
+    client.post("/add_patient", json=patient("P001"))
+    assert client.get("/patients/P001").json()["data"]["city"] == "Pune"
+
+    client.put("/update_patient/P001", json={"city": "Delhi"})
+    assert client.get("/patients/P001").json()["data"]["city"] == "Delhi"
+
+    external_write("UPDATE patients SET city = 'Goa' WHERE id = 'P001'")
+    assert client.get("/patients/P001").json()["data"]["city"] == "Goa"
+
+    client.delete("/delete_patient/P001")
+    assert client.get("/patients/P001").status_code == 404
+
+
+def sorted_names(client, sort_by="height", order="asc"):
+    response = client.get("/sort_patients", params={"sort_by": sort_by, "order": order})
+    return [record["name"] for record in response.json()["data"]]
+
+
+def test_sorted_responses_follow_writes(client):
+    client.post("/add_patient", json=patient("P001", name="Asha", height=1.70))
+    client.post("/add_patient", json=patient("P002", name="Ravi", height=1.80))
+    assert sorted_names(client) == ["Asha", "Ravi"]
+
+    client.put("/update_patient/P001", json={"height": 1.90})
+    assert sorted_names(client) == ["Ravi", "Asha"]
+
+    external_write("UPDATE patients SET height = 1.60 WHERE id = 'P001'")
+    assert sorted_names(client) == ["Asha", "Ravi"]
+
+
+def test_view_follows_writes_and_cache_reloads(client):
+    client.post("/add_patient", json=patient("P001"))
+    assert set(client.get("/view_patients_data").json()["data"]) == {"P001"}
+
+    client.post("/add_patient", json=patient("P002"))
+    assert set(client.get("/view_patients_data").json()["data"]) == {"P001", "P002"}
+
+    external_write("DELETE FROM patients WHERE id = 'P001'")
+    assert set(client.get("/view_patients_data").json()["data"]) == {"P002"}
+
+    # A reload under an unchanged generation must not serve bytes encoded from the replaced data
+    utils._CACHE["data"] = None
+    with utils._write_lock:
+        utils._insert(utils._writer(), "P003", utils.Patient(**patient("P003")).to_record())
+    assert set(client.get("/view_patients_data").json()["data"]) == {"P002", "P003"}
+
+
+def test_update_recomputes_bmi_and_verdict(client):
+    client.post("/add_patient", json=patient("P001", height=1.75, weight=70))
+    assert client.get("/patients/P001").json()["data"]["verdict"] == "Normal weight"
+
+    assert client.put("/update_patient/P001", json={"weight": 95}).status_code == 200
+    updated = client.get("/patients/P001").json()["data"]
+    assert updated["weight"] == 95
+    assert updated["bmi"] == utils.calculate_bmi(95, 1.75)
+    assert updated["verdict"] == "Obese"
+
+    client.put("/update_patient/P001", json={"height": 1.9, "city": "Delhi"})
+    updated = client.get("/patients/P001").json()["data"]
+    assert updated["bmi"] == utils.calculate_bmi(95, 1.9)
+    assert updated["verdict"] == "Overweight"
+    assert updated["city"] == "Delhi"
+    assert updated["name"] == "Asha"
+
+
+def test_sort_direction_keeps_ties_in_insertion_order(client):
+    for patient_id, name, weight in [("P003", "Asha", 60), ("P001", "Ravi", 80), ("P002", "Meera", 60), ("P004", "Kiran", 70)]:
+        client.post("/add_patient", json=patient(patient_id, name=name, weight=weight))
+
+    assert sorted_names(client, "weight", "asc") == ["Asha", "Meera", "Kiran", "Ravi"]
+    assert sorted_names(client, "weight", "desc") == ["Ravi", "Kiran", "Asha", "Meera"]
+
+
+def test_sort_rejects_unknown_field_and_order(client):
+    assert client.get("/sort_patients", params={"sort_by": "age", "order": "asc"}).status_code == 400
+    assert client.get("/sort_patients", params={"sort_by": "bmi", "order": "up"}).status_code == 400
@@ -0,0 +1,56 @@
+import utils
+from conftest import load_patients
+
+
+def patient(patient_id, **overrides):
+    body = {"id": patient_id, "name": "Asha", "city": "Pune", "age": 30, "gender": "female",
+            "height": 1.65, "weight": 60}
+    body.update(overrides)
+    return body
+
+
+def test_batch_reports_per_item_results(client):
+    assert client.post("/add_patient", json=patient("P001")).status_code == 201
+
+    response = client.post("/patients:batch", json=[
+        patient("P002"),
+        patient("P001"),
+        patient("P003", age=0),
+        patient("P002"),
+        "not a patient",
+    ])
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [(r["id"], r["status"]) for r in results] == [
+        ("P002", "ok"), ("P001", "error"), ("P003", "error"), ("P002", "error"), (None, "error"),
+    ]
+    assert results[0]["detail"] is None
+    assert "already exists" in results[1]["detail"]
+    assert set(load_patients()) == {"P001", "P002"}
+
+
+def test_batch_reports_rows_added_behind_the_cache(client):
+    assert client.post("/patients:batch", json=[patient("P001")]).status_code == 200
+    # Write straight to the database without bumping the generation so the cached copy goes stale
+    with utils._write_lock:
+        utils._insert(utils._writer(), "P002", utils.Patient(**patient("P002")).to_record())
+
+    results = client.post("/patients:batch", json=[patient("P002"), patient("P003")]).json()["results"]
+
+    assert [(r["id"], r["status"]) for r in results] == [("P002", "error"), ("P003", "ok")]
+
+
+def test_batch_rejects_non_array_body(client):
+    assert client.post("/patients:batch", json={"id": "P001"}).status_code == 422
+
+
+def test_batch_leaves_the_cache_untouched_when_nothing_is_saved(client):
+    assert client.post("/patients:batch", json=[patient("P001")]).status_code == 200
+    cached = load_patients()
+
+    results = client.post("/patients:batch", json=[patient("P001"), patient("P002", age=0)]).json()["results"]
+
+    assert [r["status"] for r in results] == ["error", "error"]
+    assert load_patients() is cached
+    assert set(cached) == {"P001"}
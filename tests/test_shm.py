@@ -0,0 +1,63 @@
+import uuid
+
+import pytest
+
+import shm
+import utils
+from conftest import load_patients
+
+
+@pytest.fixture
+def snapshot(store, monkeypatch):
+    """Enable the shared snapshot with a blob and version segment private to this test"""
+    monkeypatch.setattr(shm, "SHM_ENABLED", True)
+    monkeypatch.setattr(shm, "SHM_BLOB", str(store / "patients.bin"))
+    monkeypatch.setattr(shm, "SHM_VERSION_NAME", f"patients_test_{uuid.uuid4().hex[:8]}")
+    monkeypatch.setattr(shm, "_version", None)
+    yield
+    shm._version_segment().close()
+    shm._version_segment().unlink()
+
+
+def test_load_before_any_publish(snapshot):
+    assert shm.read_version() == 0
+    assert shm.load(0) is None
+
+
+def test_load_only_returns_the_requested_version(snapshot):
+    shm.publish({"P001": {"name": "Asha"}}, 7)
+
+    assert shm.read_version() == 7
+    assert shm.load(7) == {"P001": {"name": "Asha"}}
+    assert shm.load(6) is None
+
+
+def test_load_rejects_a_publish_in_progress(snapshot, monkeypatch):
+    shm.publish({"P001": {"name": "Asha"}}, 7)
+    # publish() resets the version before replacing the blob, as if it started mid-read
+    versions = iter([7, 0])
+    monkeypatch.setattr(shm, "read_version", lambda: next(versions))
+
+    assert shm.load(7) is None
+
+
+def test_writes_publish_what_other_workers_load(snapshot, monkeypatch):
+    utils.save_changes([("add", "P001", {"name": "Asha", "city": "Pune", "age": 30, "gender": "female",
+                                        "height": 1.65, "weight": 60.0, "bmi": 22.04, "verdict": "Normal weight"})])
+    assert shm.read_version() == utils._current_stamp()
+
+    # A worker with an empty cache picks the snapshot up without reading every row
+    utils.invalidate_patient_cache()
+    monkeypatch.setattr(utils, "_read_db", lambda: pytest.fail("read the database instead of the snapshot"))
+    assert set(load_patients()) == {"P001"}
+
+
+def test_startup_republishes_a_stale_snapshot(snapshot):
+    utils.save_changes([("delete", "P001", None)])
+    generation = utils._current_stamp()
+    shm.publish({"P999": {"name": "Restored over"}}, generation - 1)
+
+    utils.sync_shared_snapshot()
+
+    assert shm.read_version() == generation
+    assert shm.load(generation) == {}
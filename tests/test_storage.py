@@ -0,0 +1,73 @@
+import sqlite3
+
+import orjson
+import pytest
+
+import utils
+from conftest import load_patients, reset_connections
+
+
+def record(name, age=30):
+    return {"name": name, "city": "Pune", "age": age, "gender": "male", "height": 1.8, "weight": 72.0,
+            "bmi": 22.22, "verdict": "Normal weight"}
+
+
+def test_imports_legacy_json_and_wal(store):
+    (store / "patient_details.json").write_bytes(orjson.dumps({"P001": record("Asha"), "P002": record("Ravi")}))
+    (store / "patient_details.wal").write_bytes(
+        orjson.dumps({"op": "delete", "id": "P002"}) + b"\n"
+        + orjson.dumps({"op": "put", "id": "P003", "rec": record("Meera")}) + b"\n"
+        + orjson.dumps({"op": "put", "id": "P001", "rec": record("Asha", age=31)}) + b"\n"
+    )
+
+    assert load_patients() == {"P001": record("Asha", age=31), "P003": record("Meera")}
+
+
+def test_legacy_import_runs_only_once(store):
+    (store / "patient_details.json").write_bytes(orjson.dumps({"P001": record("Asha")}))
+    utils.save_changes([("delete", "P001", None)])
+
+    reset_connections()
+    assert load_patients() == {}
+
+
+def test_empty_store_without_legacy_files(store):
+    assert load_patients() == {}
+
+
+def test_add_existing_patient_raises(store):
+    utils.save_changes([("add", "P001", record("Asha"))])
+    with pytest.raises(sqlite3.IntegrityError):
+        utils.save_changes([("add", "P001", record("Ravi"))])
+    assert load_patients() == {"P001": record("Asha")}
+
+
+def test_cache_hits_share_the_cached_dict(store):
+    utils.save_changes([("add", "P001", record("Asha"))])
+
+    first = load_patients()
+    assert load_patients() is first
+
+
+def test_write_patches_the_current_cache_in_place(store):
+    utils.save_changes([("add", "P001", record("Asha")), ("add", "P002", record("Ravi"))])
+    cached = load_patients()
+
+    utils.save_changes([("put", "P001", record("Asha", age=31)), ("delete", "P002", None)])
+
+    assert load_patients() is cached
+    assert cached == {"P001": record("Asha", age=31)}
+
+
+def test_write_drops_a_cache_left_stale_by_another_process(store):
+    utils.save_changes([("add", "P001", record("Asha"))])
+    stale = load_patients()
+    other = sqlite3.connect(utils.DB_FILE, isolation_level=None)
+    other.execute("DELETE FROM patients WHERE id = 'P001'")
+    other.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+    other.close()
+
+    utils.save_changes([("add", "P002", record("Ravi"))])
+
+    assert stale == {"P001": record("Asha")}
+    assert load_patients() == {"P002": record("Ravi")}
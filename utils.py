@@ -1,51 +1,416 @@
-from pydantic import BaseModel, Field, computed_field
+from msgspec import Meta
 from typing import Annotated, Literal, Optional
-import json
+import asyncio
+import functools
+import msgspec
+import orjson
+import os
+import sqlite3
+import threading
 
+import shm
 
-class Patient(BaseModel):
 
-    id: Annotated[str, Field(..., description="Unique identifier for the patient", examples=["P001"])]
-    name: Annotated[str, Field(..., description="Name of the patient", examples=["Hazel Grace"])]
-    city: Annotated[str, Field(..., description="City where the patient resides", examples=["New York"])]
-    age: Annotated[int, Field(..., gt=0, lt= 120, description="Age of the patient", examples=[30])]
-    gender: Annotated[Literal['male', 'female', 'others'], Field(..., description="Gender of the patient")]
-    height: Annotated[float, Field(..., gt=0, description="Height of the patient in mtrs", examples=[1.75])]
-    weight: Annotated[float, Field(..., gt=0, description="Weight of the patient in kg", examples=[70.2])]
+DB_FILE = "data/patients.db"
+# Legacy JSON store (and its change log), imported into DB_FILE the first time the database is created
+DATA_FILE = "data/patient_details.json"
+WAL_FILE = "data/patient_details.wal"
+SORTABLE_FIELDS = ["height", "weight", "bmi"]
+RECORD_FIELDS = ["name", "city", "age", "gender", "height", "weight", "bmi", "verdict"]
+
+# All patients as read from the database, keyed on the database generation they were read at
+_CACHE = {"stamp": None, "data": None}
+# Pre-encoded get_patient response bodies, keyed by patient id
+_ENCODED: dict[str, bytes] = {}
+# Readers and the writer use separate connections so that, in WAL mode, reads never wait on a write.
+# Each connection is serialized through its own lock; _lock only guards the in-memory state above.
+# The generation check runs on the event loop, so it gets a connection of its own that is never
+# held for longer than that one indexed lookup.
+_read_conn = None
+_write_conn = None
+_stamp_conn = None
+_read_lock = threading.Lock()
+_write_lock = threading.Lock()
+_stamp_lock = threading.Lock()
+_lock = threading.RLock()
+
+
+def calculate_bmi(weight, height):
+    """Calculate Body Mass Index (BMI)"""
+    return round(weight / (height ** 2), 2)
+
+def bmi_verdict(bmi):
+    """Determine the health verdict based on BMI"""
+    if bmi < 18.5:
+        return "Underweight"
+    elif 18.5 <= bmi < 24.9:
+        return "Normal weight"
+    elif 25 <= bmi < 29.9:
+        return "Overweight"
+    else:
+        return "Obese"
+
+
+class Patient(msgspec.Struct):
+
+    id: Annotated[str, Meta(description="Unique identifier for the patient", examples=["P001"])]
+    name: Annotated[str, Meta(description="Name of the patient", examples=["Hazel Grace"])]
+    city: Annotated[str, Meta(description="City where the patient resides", examples=["New York"])]
+    age: Annotated[int, Meta(gt=0, lt=120, description="Age of the patient", examples=[30])]
+    gender: Annotated[Literal['male', 'female', 'others'], Meta(description="Gender of the patient")]
+    height: Annotated[float, Meta(gt=0, description="Height of the patient in mtrs", examples=[1.75])]
+    weight: Annotated[float, Meta(gt=0, description="Weight of the patient in kg", examples=[70.2])]
 
-    @computed_field
-    @property
     def bmi(self) -> float:
         """Calculate Body Mass Index (BMI)"""
-        return round(self.weight / (self.height ** 2), 2)
-    
-    @computed_field
-    @property
+        return calculate_bmi(self.weight, self.height)
+
     def verdict(self) -> str:
         """Determine the health verdict based on BMI"""
-        if self.bmi < 18.5:
-            return "Underweight"
-        elif 18.5 <= self.bmi < 24.9:
-            return "Normal weight"
-        elif 25 <= self.bmi < 29.9:
-            return "Overweight"
-        else:
-            return "Obese"
-        
-class UpdatePatient(BaseModel):
-    name: Annotated[Optional[str], Field(default=None, description="Name of the patient", examples=["Hazel Grace"])]
-    city: Annotated[Optional[str], Field(default=None, description="City where the patient resides", examples=["New York"])]
-    age: Annotated[Optional[int], Field(default=None, gt=0, lt= 120, description="Age of the patient", examples=[30])]
-    gender: Annotated[Optional[Literal['male', 'female', 'others']], Field(default=None, description="Gender of the patient")]
-    height: Annotated[Optional[float], Field(default=None, gt=0, description="Height of the patient in mtrs", examples=[1.75])]
-    weight: Annotated[Optional[float], Field(default=None, gt=0, description="Weight of the patient in kg", examples=[70.2])]
-
-
-def load_patient_data():
-    with open("data/patient_details.json", "r") as file:
-        data = json.load(file)
+        return bmi_verdict(self.bmi())
+
+    def to_record(self) -> dict:
+        """Stored form of the patient, with bmi and verdict materialized so reads never recompute them"""
+        record = msgspec.structs.asdict(self)
+        del record['id']
+        record['bmi'] = self.bmi()
+        record['verdict'] = self.verdict()
+        return record
+
+class UpdatePatient(msgspec.Struct):
+    name: Optional[Annotated[str, Meta(description="Name of the patient", examples=["Hazel Grace"])]] = None
+    city: Optional[Annotated[str, Meta(description="City where the patient resides", examples=["New York"])]] = None
+    age: Optional[Annotated[int, Meta(gt=0, lt=120, description="Age of the patient", examples=[30])]] = None
+    gender: Optional[Annotated[Literal['male', 'female', 'others'], Meta(description="Gender of the patient")]] = None
+    height: Optional[Annotated[float, Meta(gt=0, description="Height of the patient in mtrs", examples=[1.75])]] = None
+    weight: Optional[Annotated[float, Meta(gt=0, description="Weight of the patient in kg", examples=[70.2])]] = None
+
+
+def _replay_wal(data, wal_bytes):
+    """Apply the changes recorded in the legacy change log on top of the JSON file contents"""
+    for line in wal_bytes.splitlines():
+        if not line:
+            continue
+        change = orjson.loads(line)
+        if change["op"] == "put":
+            data[change["id"]] = change["rec"]
+        elif change["op"] == "delete":
+            data.pop(change["id"], None)
     return data
 
-def save_patient_data(data):
-    with open("data/patient_details.json", "w") as file:
-        json.dump(data, file)
\ No newline at end of file
+def _import_legacy_data(conn):
+    """Load the legacy JSON store into a freshly created database"""
+    data = {}
+    if os.path.exists(DATA_FILE):
+        with open(DATA_FILE, "rb") as file:
+            data = orjson.loads(file.read())
+    if os.path.exists(WAL_FILE):
+        with open(WAL_FILE, "rb") as file:
+            _replay_wal(data, file.read())
+    _upsert(conn, data.items())
+
+def _open_connection():
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def _writer():
+    """Return the write connection, creating the schema and importing legacy data on first use
+
+    Callers must hold _write_lock.
+    """
+    global _write_conn
+    if _write_conn is None:
+        conn = _open_connection()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS patients (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                city TEXT NOT NULL,
+                age INTEGER NOT NULL,
+                gender TEXT NOT NULL,
+                height REAL NOT NULL,
+                weight REAL NOT NULL,
+                bmi REAL NOT NULL,
+                verdict TEXT NOT NULL
+            )
+        """)
+        # Bumped by every write transaction, so any process can tell whether its cached data is current
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        # Starts at 1 so it never matches the shared snapshot's "nothing published" version of 0
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 1)")
+        # user_version marks the import as done, so deleting every patient doesn't re-import the JSON
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+                _import_legacy_data(conn)
+                conn.execute("PRAGMA user_version = 1")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        _write_conn = conn
+    return _write_conn
+
+def _reader():
+    """Return the read connection, callers must hold _read_lock"""
+    global _read_conn
+    if _read_conn is None:
+        # Make sure the schema exists before the first read
+        with _write_lock:
+            _writer()
+        _read_conn = _open_connection()
+    return _read_conn
+
+def _insert(conn, patient_id, record):
+    """Insert a new patient, raising sqlite3.IntegrityError if the id is already taken"""
+    columns = ", ".join(["id"] + RECORD_FIELDS)
+    placeholders = ", ".join(f":{field}" for field in ["id"] + RECORD_FIELDS)
+    conn.execute(f"INSERT INTO patients ({columns}) VALUES ({placeholders})", {"id": patient_id, **record})
+
+def _upsert(conn, items):
+    columns = ", ".join(["id"] + RECORD_FIELDS)
+    placeholders = ", ".join(f":{field}" for field in ["id"] + RECORD_FIELDS)
+    updates = ", ".join(f"{field} = excluded.{field}" for field in RECORD_FIELDS)
+    conn.executemany(
+        f"INSERT INTO patients ({columns}) VALUES ({placeholders}) ON CONFLICT(id) DO UPDATE SET {updates}",
+        [{"id": patient_id, **record} for patient_id, record in items],
+    )
+
+def _generation(conn):
+    return conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+
+def _select_all(conn):
+    rows = conn.execute(f"SELECT id, {', '.join(RECORD_FIELDS)} FROM patients ORDER BY rowid")
+    return {row[0]: dict(zip(RECORD_FIELDS, row[1:])) for row in rows}
+
+def _read_db():
+    """Read the generation and every patient, in insertion order, from one consistent snapshot"""
+    with _read_lock:
+        conn = _reader()
+        conn.execute("BEGIN")
+        try:
+            return _generation(conn), _select_all(conn)
+        finally:
+            conn.execute("COMMIT")
+
+def _current_stamp():
+    """Return the database generation, which identifies the current data
+
+    Cheap enough to call on the event loop: in WAL mode the lookup never waits on a writer.
+    """
+    global _stamp_conn
+    with _stamp_lock:
+        if _stamp_conn is None:
+            with _write_lock:
+                _writer()
+            _stamp_conn = _open_connection()
+        return _generation(_stamp_conn)
+
+def open_database():
+    """Open every connection up front, creating the schema and importing legacy data if needed
+
+    Meant to run in a worker thread at startup, so requests never pay for the first open.
+    """
+    with _read_lock:
+        _reader()
+    _current_stamp()
+
+def sync_shared_snapshot():
+    """Republish the shared snapshot from the database if it doesn't match the current generation
+
+    The snapshot outlives the workers, so it can be stale after a restart, e.g. once a backup was
+    restored over the database. Holding the write lock keeps this from racing with a writer's publish.
+    """
+    if not shm.is_enabled():
+        return
+    with _write_lock:
+        conn = _writer()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            generation = _generation(conn)
+            if shm.read_version() != generation:
+                shm.publish(_select_all(conn), generation)
+        finally:
+            conn.execute("COMMIT")
+
+def _clear_encoded():
+    """Drop every pre-encoded response, they were built from the data being replaced"""
+    _ENCODED.clear()
+    _view_bytes.cache_clear()
+    _sorted_bytes.cache_clear()
+
+def _set_cache(data, stamp):
+    with _lock:
+        _CACHE["data"] = data
+        _CACHE["stamp"] = stamp
+        _clear_encoded()
+
+def _cached(stamp):
+    with _lock:
+        if _CACHE["data"] is not None and _CACHE["stamp"] == stamp:
+            return _CACHE["data"]
+    return None
+
+async def load_patient_data_async():
+    """Return patient data, re-reading it from the shared snapshot or the database only when it changed
+
+    The returned dict is the cache itself, so callers must treat it as read-only.
+    """
+    # Only the miss below leaves the event loop, a cache hit costs one generation lookup
+    stamp = _current_stamp()
+    data = _cached(stamp)
+    if data is not None:
+        return data
+
+    data = None
+    if shm.is_enabled():
+        data = shm.load(stamp)
+    if data is None:
+        stamp, data = await asyncio.to_thread(_read_db)
+
+    _set_cache(data, stamp)
+    return data
+
+def invalidate_patient_cache():
+    """Drop the local cache so the next read goes back to the database"""
+    with _lock:
+        _CACHE["data"] = None
+        _CACHE["stamp"] = None
+        _clear_encoded()
+
+def get_patient_bytes(data, patient_id):
+    """Return the encoded get_patient response body, reusing it while the record is unchanged"""
+    with _lock:
+        body = _ENCODED.get(patient_id)
+        if body is None:
+            body = orjson.dumps({"status": "success", "data": data[patient_id]})
+            # Only keep it if `data` is still the cached version of this record
+            if _CACHE["data"] is not None and _CACHE["data"].get(patient_id) is data[patient_id]:
+                _ENCODED[patient_id] = body
+        return body
+
+@functools.lru_cache(maxsize=1)
+def _view_bytes(stamp):
+    """Encoded view_patients_data response for the cached data identified by `stamp`"""
+    return orjson.dumps({"status": "success", "data": _CACHE["data"]})
+
+def get_view_bytes(data):
+    """Return the encoded view_patients_data response, reused until the data changes"""
+    with _lock:
+        if _CACHE["data"] is None:
+            return orjson.dumps({"status": "success", "data": data})
+        return _view_bytes(_CACHE["stamp"])
+
+def sort_patient_records(sort_by, descending=False):
+    """Return patient records ordered by `sort_by`, ties kept in insertion order"""
+    if sort_by not in SORTABLE_FIELDS:
+        raise ValueError(f"Invalid sort field: {sort_by}")
+    direction = "DESC" if descending else "ASC"
+    with _read_lock:
+        rows = _reader().execute(
+            f"SELECT {', '.join(RECORD_FIELDS)} FROM patients ORDER BY {sort_by} {direction}, rowid"
+        )
+        return [dict(zip(RECORD_FIELDS, row)) for row in rows]
+
+@functools.lru_cache(maxsize=16)
+def _sorted_bytes(sort_by, descending, stamp):
+    """Encoded sort_patients response for the data identified by `stamp`"""
+    records = sort_patient_records(sort_by, descending)
+    return orjson.dumps({"status": "success", "data": records})
+
+def get_sorted_patients_bytes(sort_by, descending=False):
+    """Return the encoded sort_patients response, reused until the data changes"""
+    return _sorted_bytes(sort_by, descending, _current_stamp())
+
+def _apply_changes(data, changes):
+    """Apply (op, patient_id, record) changes that were written to the database to `data`"""
+    for op, patient_id, record in changes:
+        if op == "delete":
+            data.pop(patient_id, None)
+        else:
+            data[patient_id] = record
+
+def save_changes(changes, skip_duplicates=False):
+    """Apply (op, patient_id, record) changes in one transaction and update the cache
+
+    `op` is "add" for a new patient, "put" to replace an existing one, or "delete"; the record is
+    ignored for deletes. An "add" for an id that already exists raises sqlite3.IntegrityError and
+    rolls back the whole transaction, unless `skip_duplicates` is set, in which case that change is
+    skipped. Returns the list of skipped ids.
+    """
+    with _write_lock:
+        conn = _writer()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # No other process can commit while we hold the write lock, so this generation is exact
+            generation = _generation(conn)
+
+            # Only the shared snapshot needs every patient, start from the cache when it is current
+            data = None
+            from_cache = False
+            if shm.is_enabled():
+                with _lock:
+                    if _CACHE["data"] is not None and _CACHE["stamp"] == generation:
+                        data = dict(_CACHE["data"])
+                        from_cache = True
+                if data is None:
+                    data = _select_all(conn)
+
+            applied = []
+            duplicates = []
+            for op, patient_id, record in changes:
+                if op == "add":
+                    try:
+                        _insert(conn, patient_id, record)
+                    except sqlite3.IntegrityError:
+                        if not skip_duplicates:
+                            raise
+                        duplicates.append(patient_id)
+                        continue
+                elif op == "put":
+                    _upsert(conn, [(patient_id, record)])
+                else:
+                    conn.execute("DELETE FROM patients WHERE id = ?", (patient_id,))
+                applied.append((op, patient_id, record))
+
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+
+            # Publish while still holding the database write lock, so snapshots from different
+            # processes go out in generation order and each one contains every committed write
+            if data is not None:
+                _apply_changes(data, applied)
+                shm.publish(data, generation + 1)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        # Still under the write lock, so no other write from this process can slip in between
+        with _lock:
+            if data is not None:
+                _CACHE["data"] = data
+            elif _CACHE["data"] is not None and _CACHE["stamp"] == generation:
+                # Patch the current cache in place instead of copying every patient
+                _apply_changes(_CACHE["data"], applied)
+                from_cache = True
+            else:
+                # Stale (another process wrote since), the next read reloads it
+                _CACHE["data"] = None
+            _CACHE["stamp"] = generation + 1
+
+            if from_cache:
+                for op, patient_id, record in applied:
+                    _ENCODED.pop(patient_id, None)
+            else:
+                _clear_encoded()
+    return duplicates
+
+async def save_changes_async(changes, skip_duplicates=False):
+    """Save changes without blocking the event loop
+
+    Other workers notice the write through the database generation. Returns the ids of "add" changes
+    skipped as duplicates, see save_changes.
+    """
+    return await asyncio.to_thread(save_changes, changes, skip_duplicates)